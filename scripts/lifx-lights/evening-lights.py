@@ -20,22 +20,79 @@
 # depends on: pip install lifxlan
 # https://github.com/mclarkk/lifxlan
 
+# depends on: pip install diskcache
+# https://github.com/grantjenks/python-diskcache
+
+# depends on: pip install urllib3
+# https://github.com/urllib3/urllib3
+
+import os
 import sys
+import json
 import time
-import requests
-
+import signal
+import heapq
+import asyncio
+import urllib3
+import threading
+import diskcache
+
+from urllib3.util.retry import Retry
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta, timezone
 from datetime import time as _time
 from datetime import date as _date
 
 from lifxlan import LifxLAN
 from lifxlan import Group as LifxGroup
-from lifxlan import Device as LifXDevice
 
 # Power states
 POWER_ON = True
 POWER_OFF = False
 
+# color states (HUE, SATURATION, BRIGHTNESS, TEMPERATURE[Kelvin])
+COLOR_NIGHT_LIGHT = (8402, 0, 49151, 2000)
+COLOR_NEUTRAL_LIGHT = (8402, 0, 65535, 3500)
+
+# config
+SUNSET_OFFSET = timedelta(minutes=-30)
+TRANSITION_DURATION = timedelta(minutes=5)
+LATITUDE, LONGITUDE = (45.42178, -75.69119)
+
+# set by the SIGINT handler, the main loop shuts down when it's set
+_shutdown = asyncio.Event()
+
+# keep-alive connection pool reused for all sunrise-sunset api requests,
+# transient network errors are retried with exponential backoff
+_RETRY = Retry(total=3,
+               backoff_factor=0.3,
+               status_forcelist=[429, 500, 502, 503, 504],
+               allowed_methods=["GET"])
+_HTTP = urllib3.PoolManager(num_pools=2,
+                            maxsize=2,
+                            retries=_RETRY,
+                            timeout=urllib3.Timeout(total=10))
+
+# raised by request_sunrise_sunset when the api request still fails
+# after retrying, or when the response can't be parsed
+_API_ERRORS = (urllib3.exceptions.HTTPError, KeyError, ValueError)
+
+
+def get_http() -> urllib3.PoolManager:
+    """Returns the http connection pool shared by all api requests"""
+    return _HTTP
+
+
+# persistent cache of sunrise-sunset api results, survives restarts
+_CACHE = diskcache.Cache(os.path.expanduser("~/.cache/evening-lights"))
+_CACHE_EXPIRE = 7 * 86400  # seconds
+
+# the most the sunset time can drift from one day to the next
+_SUNSET_DRIFT = timedelta(minutes=10)
+
 
 def utc_now() -> datetime:
     """All datetime values used must be in UTC. The exception
@@ -49,40 +106,101 @@ def utc_datetime(date: _date, time: _time) -> datetime:
     return datetime.combine(date, time).astimezone(timezone.utc)
 
 
-def sleep_until(then: datetime, timeout: timedelta = None) -> None:
+async def interruptible_sleep(seconds: float,
+                              wake: asyncio.Event = None) -> None:
+    """Sleeps for a number of seconds, raises KeyboardInterrupt as
+    soon as a shutdown is requested or TimeoutError as soon as the
+    optional wake event is set"""
+    events = [_shutdown] if wake is None else [_shutdown, wake]
+    waiters = [asyncio.create_task(ev.wait()) for ev in events]
+    try:
+        await asyncio.wait(waiters,
+                           timeout=seconds,
+                           return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for waiter in waiters:
+            waiter.cancel()
+    if _shutdown.is_set():
+        raise KeyboardInterrupt
+    if wake is not None and wake.is_set():
+        raise TimeoutError
+
+
+async def sleep_until(then: datetime,
+                      timeout: timedelta = None,
+                      interruptible: bool = False,
+                      wake: asyncio.Event = None) -> None:
     """Sleeps until a specified UTC datetime or raises TimeoutError
-    after timing out"""
-    wait_time = then - utc_now()
-    if timeout and timeout < wait_time:
-        time.sleep(timeout.total_seconds())
+    after timing out, other coroutines keep running while asleep.
+    If interruptible, raises KeyboardInterrupt on shutdown and
+    TimeoutError as soon as the optional wake event is set"""
+    if interruptible:
+        def sleep(seconds):
+            return interruptible_sleep(seconds, wake)
+    else:
+        sleep = asyncio.sleep
+    wait = then.timestamp() - time.time()
+    timeout_s = timeout.total_seconds() if timeout else None
+    if timeout_s is not None and timeout_s < wait:
+        await sleep(timeout_s)
         raise TimeoutError
-    if wait_time > timedelta(0):
-        time.sleep(wait_time.total_seconds())
+    if wait > 0:
+        await sleep(wait)
+
+
+def date_string(date: datetime) -> str:
+    """Formats a date or datetime as YYYY-MM-DD"""
+    if isinstance(date, datetime):
+        date = date.date()
+    return date.isoformat()
+
+
+def sunrise_sunset_key(lat: float, lng: float, date_str: str) -> str:
+    """Cache key for the sunrise and sunset times of a UTC date,
+    given as a YYYY-MM-DD string"""
+    return f"{lat:.5f},{lng:.5f},{date_str}"
 
 
 def request_sunrise_sunset(lat: float, lng: float, date: datetime):
     """Uses service provided by https://sunrise-sunset.org/api
-    Retrieves the sunrise and sunset times in UTC for a given UTC date
+    Retrieves the sunrise and sunset times in UTC for a given UTC date,
+    results are cached on disk so the api is called at most once per date
     """
     url = "http://api.sunrise-sunset.org/json"
-    date_str = date.strftime("%Y-%m-%d")
-    params = f"?lat={lat}&lng={lng}&date={date_str}&formatted=0"
+    date_str = date_string(date)
+
+    key = sunrise_sunset_key(lat, lng, date_str)
+    cached = _CACHE.get(key)
+    if cached is not None:
+        return cached
+
+    params = {"lat": lat, "lng": lng, "date": date_str, "formatted": 0}
 
     # expect exception if request fails, parsing json fails,
     # there are no results, or date format changes
-    payload = requests.get(url+params, timeout=5).json()["results"]
-    sunrise = datetime.strptime(payload["sunrise"], "%Y-%m-%dT%H:%M:%S%z")
-    sunset = datetime.strptime(payload["sunset"], "%Y-%m-%dT%H:%M:%S%z")
+    response = get_http().request("GET", url, fields=params)
+    if response.status != 200:
+        raise urllib3.exceptions.HTTPError(f"status {response.status}")
+    body = json.loads(response.data)
+    payload = body.get("results") if isinstance(body, dict) else None
+    if not isinstance(payload, dict):
+        raise ValueError(f"unexpected sunrise-sunset results: {payload!r}")
+    times = (payload.get("sunrise"), payload.get("sunset"))
+    if not all(isinstance(t, str) for t in times):
+        raise ValueError(f"unexpected sunrise-sunset times: {times!r}")
+    sunrise = datetime.fromisoformat(times[0])
+    sunset = datetime.fromisoformat(times[1])
+    _CACHE.set(key, (sunrise, sunset), expire=_CACHE_EXPIRE)
     return (sunrise, sunset)
 
 
 def get_sunset_or_default(lat: float, lng: float, date: datetime) -> datetime:
     """Get sunset datetime from request or default time if request
-    fails for any reason"""
+    still fails after retrying or the response can't be parsed"""
     try:
         _, sunset = request_sunrise_sunset(lat, lng, date)
         return sunset
-    except Exception as e:
+    except _API_ERRORS as e:
         print("warning: exception raised while requesting sunrise-sunset")
         print(e)
         # fallback to default time of 5:30 PM
@@ -91,133 +209,210 @@ def get_sunset_or_default(lat: float, lng: float, date: datetime) -> datetime:
         return utc_datetime(local_date, local_time)
 
 
+def prewarm_sunrise_sunset(lat: float, lng: float, days: int = 7) -> None:
+    """Requests the sunrise and sunset times of the coming days so they
+    are cached before they're needed, a later loss of internet then
+    doesn't force the default sunset time"""
+    now = utc_now()
+    for i in range(days):
+        try:
+            request_sunrise_sunset(lat, lng, now + timedelta(days=i))
+        except _API_ERRORS as e:
+            print("warning: exception raised while prewarming sunrise-sunset")
+            print(e)
+
+
 def next_sunset(lat: float, lng: float) -> datetime:
     """Returns today's sunset datetime if it has not already
-    passed. If it has passed, then returns tomorrow's sunset
+    passed. If it has passed, then returns tomorrow's sunset.
+    Yesterday's cached sunset is used to tell when today's has
+    clearly passed, so today's sunset is not requested at all
     """
     now = utc_now()
+    tomorrow = now + timedelta(days=1)
+
+    yesterday = date_string(now - timedelta(days=1))
+    cached = _CACHE.get(sunrise_sunset_key(lat, lng, yesterday))
+    if cached is not None:
+        _, yesterday_sunset = cached
+        if yesterday_sunset + timedelta(days=1) + _SUNSET_DRIFT < now:
+            return get_sunset_or_default(lat, lng, tomorrow)
+
     sunset = get_sunset_or_default(lat, lng, now)
     if sunset > now:
         return sunset
-    return get_sunset_or_default(lat, lng, now + timedelta(days=1))
+    return get_sunset_or_default(lat, lng, tomorrow)
 
 
-def already_in_group(device: LifXDevice, group: LifxGroup) -> bool:
-    """Checks if a device has already been added to the group"""
-    group_addresses = [dev.mac_addr for dev in group.get_device_list()]
-    return device.mac_addr in group_addresses
+# last power state applied to each group of lights, keyed by id(group)
+_applied_power = {}
 
 
+@dataclass(frozen=True, slots=True)
 class LampState:
-    """Defines the state of a LifX Light or LifX Group as (power, color)"""
+    """Defines the state of a LifX Light or LifX Group as (power, color),
+    states compare equal when their power and color are the same"""
+    name: str = field(compare=False)
+    power: bool
+    color: tuple
 
-    def __init__(self, name: str, power: bool, color: tuple) -> None:
-        self.name = name
-        self.power = power
-        self.color = color
+    # delay between power and color commands, gives the lights
+    # time to settle after changing power state
+    _POWER_SETTLE = 0.25
 
-    def apply(self, lights: LifxGroup, duration: timedelta) -> None:
+    async def apply(self, lights: LifxGroup, duration: timedelta) -> None:
         """Sends commands to the lights to apply power and color settings.
         The duration parameter specifies the length of time the light should
-        take to transition to the new settings
+        take to transition to the new settings. The blocking lifx commands
+        are run in a worker thread
         """
         duration_ms = int(1000 * duration.total_seconds())
-        if self.power:
-            lights.set_power("on", duration_ms)
-            time.sleep(0.25)
-            lights.set_color(self.color, duration_ms)
-        else:
-            lights.set_color(self.color, duration_ms)
-            time.sleep(0.25)
-            lights.set_power("off", duration_ms)
+        power_changed = _applied_power.get(id(lights)) != self.power
 
-    def equals(self, other) -> bool:
-        return self.power == other.power and self.color == other.color
+        # color is not visible while the lights are off, so
+        # powering off only needs the power command
+        if not self.power:
+            await asyncio.to_thread(lights.set_power, "off", duration_ms)
+        else:
+            if power_changed:
+                await asyncio.to_thread(lights.set_power, "on", duration_ms)
+                await asyncio.sleep(self._POWER_SETTLE)
+            await asyncio.to_thread(lights.set_color, self.color, duration_ms)
+        _applied_power[id(lights)] = self.power
 
 
+@dataclass(order=True, slots=True)
 class TimeEvent:
-    """An event that triggers a transition to a new state"""
+    """An event that triggers a transition to a new state,
+    events are ordered by their UTC time"""
+    sort_index: datetime = field(init=False, repr=False)
+    name: str = field(compare=False)
+    time: datetime = field(compare=False)
+    state: LampState = field(compare=False)
+    fade: timedelta = field(default=timedelta(seconds=4), compare=False)
 
-    def __init__(self,
-                 name: str,
-                 time_utc: datetime,
-                 state: LampState,
-                 fade: timedelta = timedelta(seconds=4)) -> None:
-        self.name = name
-        self.time = time_utc
-        self.state = state
-        self.fade = fade
-
-    def __lt__(self, other) -> bool:
-        return self.time.__lt__(other.time)
+    def __post_init__(self) -> None:
+        self.sort_index = self.time
 
     def print(self) -> None:
         print(f"Timed Event: {self.name} "
               f"at {self.time.astimezone()} --> {self.state.name}")
 
-    def trigger(self, lights: LifxGroup, fade: timedelta = None) -> None:
+    async def trigger(self, lights: LifxGroup, fade: timedelta = None) -> None:
         self.print()
         if not fade:
             fade = self.fade
-        self.state.apply(lights, fade)
+        await self.state.apply(lights, fade)
 
 
 class Timeline:
-    """Maintains a sorted list of TimeEvents and allows waiting for
+    """Maintains a min-heap of TimeEvents and allows waiting for
     the next TimeEvent"""
 
     def __init__(self) -> None:
         self.timeline = []
+        # set when the events are replaced, wakes a waiting pop
+        self.changed = asyncio.Event()
 
     def insert(self, ev: TimeEvent) -> None:
-        self.timeline.append(ev)
-        self.timeline.sort()
+        heapq.heappush(self.timeline, ev)
+
+    def extend(self, evs: list) -> None:
+        """Inserts a batch of TimeEvents with a single heapify"""
+        self.timeline.extend(evs)
+        heapq.heapify(self.timeline)
+
+    def replace(self, other) -> None:
+        """Replaces all TimeEvents with those of another Timeline and
+        wakes a waiting pop so it picks up the new next TimeEvent"""
+        self.timeline = other.timeline
+        self.changed.set()
 
-    def pop(self, timeout: timedelta = None) -> TimeEvent:
+    async def pop(self, timeout: timedelta = None) -> TimeEvent:
         """Sleeps until the next TimeEvent and then returns it,
         If a TimeEvent has already passed, it's returned immediately,
         If there are no remaining TimeEvents, IndexError is raised,
-        If the wait timeouts, TimeoutError is raised
+        If the wait timeouts, TimeoutError is raised,
+        If the timeline is replaced while waiting, TimeoutError is raised,
+        If a shutdown is requested, KeyboardInterrupt is raised
         """
+        if _shutdown.is_set():
+            raise KeyboardInterrupt
+        self.changed.clear()
         next_event = self.timeline[0].time
-        sleep_until(next_event, timeout)
-        return self.timeline.pop(0)
+        await sleep_until(next_event, timeout,
+                          interruptible=True, wake=self.changed)
+        return heapq.heappop(self.timeline)
 
     def print(self) -> None:
-        for ev in self.timeline:
+        for ev in sorted(self.timeline):
             ev.print()
 
 
+def query_device_state(dev):
+    """query the (power, color) state of a device"""
+    return (dev.get_power(), dev.get_color())
+
+
 def save_current_states(devices):
-    """save the current state of all devices
-    index 0 --> mac address for confirming same device
-    index 1 --> power setting
-    index 2 --> color setting
+    """save the current state of all devices as a dict
+    of mac address --> (power setting, color setting)
+
+    devices are queried concurrently so the total wait is
+    bounded by the slowest device rather than the sum of all
     """
-    saved_states = []
-    for dev in devices:
-        saved_states.append((
-            dev.mac_addr,
-            dev.get_power(),
-            dev.get_color()
-        ))
-    return saved_states
+    with ThreadPoolExecutor(max_workers=len(devices)) as ex:
+        states = ex.map(query_device_state, devices)
+        return {dev.mac_addr: state for dev, state in zip(devices, states)}
+
+
+def reset_device_state(dev, saved_states):
+    """update device state if it is different than
+    the saved state, devices without a saved state are skipped"""
+    saved_state = saved_states.get(dev.mac_addr)
+    if saved_state is None:
+        return
+    power, color = saved_state
+    current_power, current_color = query_device_state(dev)
+
+    if current_power != power:
+        dev.set_power(power)
+    if current_color != color:
+        dev.set_color(color)
 
 
 def reset_device_states(devices, saved_states):
-    """update device state if they are different
-    than the current state"""
-    for i, dev in enumerate(devices):
-        saved_state = saved_states[i]
-        current_state = (dev.mac_addr, dev.get_power(), dev.get_color())
+    """update device states if they are different
+    than the saved states, devices are updated concurrently"""
+    with ThreadPoolExecutor(max_workers=len(devices)) as ex:
+        list(ex.map(lambda dev: reset_device_state(dev, saved_states),
+                    devices))
 
-        if current_state[1] != saved_state[1]:
-            dev.set_power(saved_state[1])
-        if current_state[2] != saved_state[2]:
-            dev.set_color(saved_state[2])
 
+async def refresh_sunset_daily(timeline: Timeline) -> None:
+    """Refills the timeline every day at 3AM so that the sunset time
+    is refreshed, eg. if the api was down when the timeline was filled
+    and the default sunset time was used"""
+    while True:
+        refresh_time = utc_datetime(datetime.now().date(), _time(hour=3))
+        if refresh_time <= utc_now():
+            refresh_time += timedelta(days=1)
+        await sleep_until(refresh_time)
+
+        # fill a new timeline in a worker thread, since it makes blocking
+        # http requests, then swap it in so the main loop never sees an
+        # empty timeline and refills it a second time
+        refreshed = Timeline()
+        try:
+            await asyncio.to_thread(fill_timeline, refreshed)
+        except Exception as e:
+            print("warning: exception raised while refreshing timeline")
+            print(e)
+            continue
+        timeline.replace(refreshed)
 
-def main():
+
+async def main():
     if len(sys.argv) < 2:
         print("Provide names for the lights and/or groups to control:\n")
         print("  ./evening-lights.py [light_name] [group_name]\n")
@@ -226,26 +421,37 @@ def main():
     print("Discovering lights...")
     lifx = LifxLAN()
 
-    # the group of lights this script will control
+    # discover once and index the devices by name and by group,
+    # rather than a discovery broadcast per label
+    by_name = {}
+    by_group = defaultdict(list)
+    for dev in lifx.get_devices():
+        by_name[dev.get_label()] = dev
+        by_group[dev.get_group_label()].append(dev)
+
+    # the group of lights this script will control, and the
+    # mac addresses of its devices for fast membership checks
     ctrl_group = LifxGroup()
+    ctrl_macs = set()
 
     # labels can be for a device or group
     labels = sys.argv[1:]
 
     for label in labels:
         # check for group name
-        group = lifx.get_devices_by_group(label)
-        devices = group.get_device_list()
+        devices = by_group.get(label, [])
         if len(devices) > 0:
             for dev in devices:
-                if not already_in_group(dev, ctrl_group):
+                if dev.mac_addr not in ctrl_macs:
                     ctrl_group.add_device(dev)
+                    ctrl_macs.add(dev.mac_addr)
         else:
             # check for device name
-            dev = lifx.get_device_by_name(label)
+            dev = by_name.get(label)
             if dev:
-                if not already_in_group(dev, ctrl_group):
+                if dev.mac_addr not in ctrl_macs:
                     ctrl_group.add_device(dev)
+                    ctrl_macs.add(dev.mac_addr)
             else:
                 print(f"No devices found matching label '{label}'")
 
@@ -263,29 +469,49 @@ def main():
     # save the current state of all lights
     saved_states = save_current_states(devices)
 
-    # timeline will be filled below
+    # fill the first timeline before prewarming, so the two
+    # don't both miss the cache and request the same dates
     timeline = Timeline()
+    await asyncio.to_thread(fill_timeline, timeline)
+
+    # fill the sunrise-sunset cache in the background
+    threading.Thread(target=prewarm_sunrise_sunset,
+                     args=(LATITUDE, LONGITUDE),
+                     daemon=True).start()
+
+    # periodic actions run concurrently with the main loop
+    refresh_task = asyncio.create_task(refresh_sunset_daily(timeline))
+
+    # on ctrl-c let any in-flight lifx commands finish, then
+    # shut down at the next Timeline.pop instead of mid-command
+    try:
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGINT, _shutdown.set)
+    except NotImplementedError:
+        # signal handlers aren't supported by the windows event loop
+        pass
 
     print("Running...")
     while True:
         try:
             """wait for the next TimeEvent and then
             trigger transition into new LampState"""
-            event = timeline.pop(timeout=None)
-            event.trigger(ctrl_group)
+            event = await timeline.pop(timeout=None)
+            await event.trigger(ctrl_group)
 
         except IndexError:
             """the timeline is empty and needs to be filled
             with the next set of TimeEvents"""
-            fill_timeline(timeline)
+            await asyncio.to_thread(fill_timeline, timeline)
 
         except TimeoutError:
             """set a timeout to have the option to take periodic
             actions while waiting for the next TimeEvent"""
             pass
 
-        except KeyboardInterrupt:
+        except (KeyboardInterrupt, asyncio.CancelledError):
             """return all lights back to how we found them"""
+            refresh_task.cancel()
             reset_device_states(devices, saved_states)
             break
 
@@ -297,39 +523,34 @@ def main():
 #   - add TimeEvents to Timeline
 ###############################################################################
 
-def fill_timeline(timeline: Timeline) -> None:
-    # color states (HUE, SATURATION, BRIGHTNESS, TEMPERATURE[Kelvin])
-    COLOR_NIGHT_LIGHT = (8402, 0, 49151, 2000)
-    COLOR_NEUTRAL_LIGHT = (8402, 0, 65535, 3500)
-
-    # config
-    SUNSET_OFFSET = timedelta(minutes=-30)
-    TRANSITION_DURATION = timedelta(minutes=5)
-    LATITUDE, LONGITUDE = (45.42178, -75.69119)
+# create valid states
+STATE_EVENING = LampState("Evening Lights", POWER_ON, COLOR_NEUTRAL_LIGHT)
+STATE_NIGHT = LampState("Night Lights", POWER_ON, COLOR_NIGHT_LIGHT)
+STATE_OFF = LampState("Lights Off", POWER_OFF, COLOR_NIGHT_LIGHT)
 
-    # create valid states
-    state_evening = LampState("Evening Lights", POWER_ON, COLOR_NEUTRAL_LIGHT)
-    state_night = LampState("Night Lights", POWER_ON, COLOR_NIGHT_LIGHT)
-    state_off = LampState("Lights Off", POWER_OFF, COLOR_NIGHT_LIGHT)
 
+def fill_timeline(timeline: Timeline) -> None:
     fade = TRANSITION_DURATION
 
     # makes a request to the free api: https://sunrise-sunset.org/api
-    # be nice and try to only call it once per day
+    # be nice, results are cached so it's only called once per day
     sunset = next_sunset(LATITUDE, LONGITUDE)
     local_date = sunset.astimezone().date()
 
     # transition into evening lights a bit before sunset
     evening = sunset + SUNSET_OFFSET
-    timeline.insert(TimeEvent("Evening", evening, state_evening, fade))
 
     # transition into night lights at 9PM
     nighttime = utc_datetime(local_date, _time(hour=21))
-    timeline.insert(TimeEvent("Nightime", nighttime, state_night, fade))
 
     # turn lights off at midnight (9PM + 3hrs)
     lightsoff = nighttime + timedelta(hours=3)
-    timeline.insert(TimeEvent("Lights Off", lightsoff, state_off, fade))
+
+    timeline.extend([
+        TimeEvent("Evening", evening, STATE_EVENING, fade),
+        TimeEvent("Nightime", nighttime, STATE_NIGHT, fade),
+        TimeEvent("Lights Off", lightsoff, STATE_OFF, fade),
+    ])
 
     print("Queued events:")
     timeline.print()
@@ -340,4 +561,9 @@ def fill_timeline(timeline: Timeline) -> None:
 
 
 if __name__ == "__main__":
-    main()
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        # interrupted before the SIGINT handler was installed,
+        # or lights were already reset when main was cancelled
+        pass